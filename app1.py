@@ -1,17 +1,37 @@
-import io
-import json
 import logging
 import re
+import re2
 import secrets
+import threading
 import time
+import functools
+import gzip
 import hashlib
-from flask import Flask, request, jsonify, Response, send_file, abort
+import heapq
+import hmac
+import os
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from flask import Flask, request, Response, abort
 from flask_cors import CORS
+from jinja2 import Environment, FileSystemLoader
+from html import unescape
+from markupsafe import Markup, escape
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import brotli
 import cohere
+import msgspec
+import orjson
+import redis
 import bleach
-from rank_bm25 import BM25Okapi
+import bm25s
+import Stemmer
+from selectolax.lexbor import LexborHTMLParser
 from slugify import slugify
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
 # ============ Configuration ============
@@ -20,6 +40,8 @@ WP_BASE = "https://agent42labs.com"
 BRAND_NAME = "Agent42 Labs"
 ALLOWED_ORIGINS = ["*"]  # Set specific domains in production
 BACKEND_API_KEY = ""     # Set if backend authentication is required
+REDIS_URL = ""           # Set (e.g. redis://localhost:6379/0) to share caches across workers
+TRUSTED_PROXIES = 0      # Reverse proxies in front that set X-Forwarded-*; 0 ignores those headers entirely
 
 RERANK_MODEL = "rerank-english-v3.0"
 FINAL_DOCS = 6
@@ -31,70 +53,139 @@ CONTACT_URL = "https://agent42labs.com/contact-us"
 
 PAGES_TTL_SEC = 86400  # 24h cache for stored pages
 ANSWER_TTL_SEC = 43200 # 12h cache for answers
+MAX_PAGES = 2000       # stored pages kept in memory, least recently viewed evicted first
+MAX_PAGES_BYTES = 256 * 1024 * 1024 # byte budget for stored page bodies, enforced alongside MAX_PAGES
+MAX_ANSWERS = 5000     # cached question -> page mappings, least recently asked evicted first
+COALESCE_TIMEOUT_SEC = 60 # how long duplicate /compose calls wait on the first one before composing themselves
+SWEEP_INTERVAL_SEC = 30 # how often the background sweeper expires pages and answers
 PORT = 8080
-
-ALLOWED_TAGS = [
-    "article", "section", "header", "footer", "nav",
-    "h1", "h2", "h3", "h4", "p", "ul", "ol", "li",
-    "a", "img", "figure", "figcaption", "blockquote",
-    "code", "pre", "em", "strong", "hr", "br", "div", "span",
-    "table", "thead", "tbody", "tr", "th", "td", "sup"
-]
+PAGE_BROTLI_QUALITY = 5 # stored pages are compressed once, so favour ratio over speed only moderately
+PAGE_GZIP_LEVEL = 5
+DOWNLOAD_CHUNK = 16384 # bytes per write when streaming page downloads
+# /compose rate limit per client IP; 0 disables it. Only enable it when clients connect directly
+# or TRUSTED_PROXIES is set, otherwise every visitor shares the proxy's address and one bucket.
+RATE_PER_SEC = 0       # sustained /compose requests per client IP, e.g. 0.5
+RATE_BURST = 10        # requests a client may make back to back before throttling
+WP_FETCH_WORKERS = 8   # concurrent page requests per WP collection fetch
+
+# Inline markup the planner may use in paragraphs; every other LLM field is plain text.
+ALLOWED_TAGS = ["em", "strong", "a"]
 
 ALLOWED_ATTRS = {
     "a": ["href", "title", "target", "rel"],
-    "img": ["src", "alt", "width", "height", "loading", "decoding", "sizes", "srcset"],
-    "*": ["class", "id", "data-*"]
 }
 
 # ============ Caches ============
 TTL = 300  # Cache TTL (5 minutes)
-POSTS_CACHE = {"ts": 0, "docs": []}
-PAGES_CACHE = {"ts": 0, "docs": []}
+# Chunked WP text is kept column-wise: index i of every list describes chunk i.
+DOC_FIELDS = ("post_ids", "titles", "urls", "chunks")
+EMPTY_CORPUS = {f: [] for f in DOC_FIELDS}
+POSTS_CACHE = {"ts": 0, "corpus": EMPTY_CORPUS}
+PAGES_CACHE = {"ts": 0, "corpus": EMPTY_CORPUS}
 MEDIA_CACHE = {"ts": 0, "imgs": []}
 
-PAGES = {}        # page_id -> {title, html, ts}
-ANSWER_CACHE = {} # cache_key -> {page_id, ts}
+@dataclass(slots=True)
+class Page:
+    title: str
+    html_bytes: bytes
+    br: bytes
+    gz: bytes
+    etag: str
+    download_name: str
+    expires: float
+    size: int                # bytes counted against MAX_PAGES_BYTES
+
+PAGES = OrderedDict()        # page_id -> Page, least recently used first
+PAGES_BYTES = 0              # sum of Page.size over PAGES
+PAGES_EXPIRY = []            # heap of (expiry ts, page_id)
+PAGES_LOCK = threading.Lock()
+ANSWER_CACHE = OrderedDict() # cache_key -> {page_id, ts}, least recently asked first
+ANSWERS_LOCK = threading.Lock()
+INFLIGHT = {}                # cache_key -> (done event, [result]) for answers being composed right now
+INFLIGHT_LOCK = threading.Lock()
+
+BM25_CACHE = {"key": None, "bm25": None, "docs": EMPTY_CORPUS}  # key = (posts ts, pages ts)
+BM25_LOCK = threading.Lock()
+BM25_REFRESH_LOCK = threading.Lock()  # held by the one thread refetching WP and rebuilding the index
+
+BUCKETS = {}                 # client ip -> (tokens, last refill on the monotonic clock)
+BUCKETS_LOCK = threading.Lock()
+
+RERANK_CACHE_SIZE = 1024
+RERANK_CACHE = OrderedDict()  # (query, corpus key, k) -> (hits, top_score)
+RERANK_LOCK = threading.Lock()
 
 # ============ Flask App ============
 app = Flask(__name__)
+# Only honour X-Forwarded-* when a proxy is known to set them; otherwise clients could spoof
+# remote_addr and get a fresh rate-limit bucket per request.
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
 CORS(app, resources={r"/compose": {"origins": ALLOWED_ORIGINS or "*"}})
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("answer-backend")
 co = cohere.Client(COHERE_API_KEY)
 http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                   max_retries=Retry(total=2, backoff_factor=0.2)))
+rds = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+stemmer = Stemmer.Stemmer("english")
+jinja_env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")),
+                        autoescape=True, trim_blocks=True, lstrip_blocks=True)
+ARTICLE_TPL = jinja_env.get_template("article.html.j2")
 
 # ============ Utility Functions ============
 def trace_id_for(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def _clean_text(s: str, tags=()) -> Markup:
+    return Markup(bleach.clean(s or "", tags=list(tags), attributes=ALLOWED_ATTRS, strip=True))
 
-def sanitize_html(html_str: str) -> str:
-    return bleach.clean(html_str, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS, strip=True)
+# re2 is a linear-time DFA engine, so tag-dense or unterminated markup cannot backtrack.
+_TAG_RE = re2.compile(r"<[^>]+>")
+_WS_NL = re.compile(r"\s+\n")
+_TOK_RE = re.compile(r"[a-z0-9]+")
+_WS_RE = re.compile(r"\s+")
 
 def _strip_html(html: str) -> str:
-    return re.sub(r"<[^>]+>", "", html or "").strip()
+    # WP "rendered" fields carry entities (&#8217;, &amp;); decode them so caches hold plain text for autoescape.
+    return unescape(_TAG_RE.sub("", html or "")).strip()
+
+def _html_to_text(html: str) -> str:
+    if not html:
+        return ""
+    if "<!--" in html:
+        # Comments may contain '>' and need a real parser to be dropped cleanly.
+        return _WS_RE.sub(" ", LexborHTMLParser(html).text(separator=" ")).strip()
+    # selectolax decodes entities, so decode here too and both paths yield the same text.
+    return _WS_RE.sub(" ", unescape(_TAG_RE.sub(" ", html))).strip()
 
 def chunk_text(text: str, max_chars=1200, overlap=120):
-    text = re.sub(r"\s+\n", "\n", text or "")
-    chunks, i, n = [], 0, len(text)
-    while i < n:
-        end = min(i + max_chars, n)
-        chunk = text[i:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        i = max(end - overlap, end)
-    return chunks
-
-def _tok(text: str):
-    return re.findall(r"[a-z0-9]+", (text or "").lower())
+    if overlap >= max_chars:
+        raise ValueError("overlap must be smaller than max_chars")
+    text = _WS_NL.sub("\n", text or "").strip()
+    if not text:
+        return []
+    # Windows advance by max_chars - overlap; stop once a window has reached the end.
+    step = max_chars - overlap
+    return [text[i:i + max_chars] for i in range(0, max(len(text) - overlap, 1), step)]
+
+@functools.lru_cache(maxsize=4096)
+def _tok_cached(text: str) -> tuple:
+    return tuple(_TOK_RE.findall((text or "").lower()))
+
+_CITE_RE = re.compile(r"\[(\d+)\]")
 
 def linkify_citations(html_str: str, citations: list) -> str:
     if not citations:
         return html_str
-    out = html_str
-    for i in range(1, len(citations) + 1):
-        out = out.replace(f'[{i}]', f'<sup class="cite"><a href="#src-{i}">{i}</a></sup>')
-    return out
+    ncit = len(citations)
+    def repl(m):
+        i = int(m.group(1))
+        if 1 <= i <= ncit:
+            return f'<sup class="cite"><a href="#src-{i}">{i}</a></sup>'
+        return m.group(0)
+    return _CITE_RE.sub(repl, html_str)
 
 def dedupe_citations(items: list) -> list:
     seen = set()
@@ -111,206 +202,405 @@ def _new_id() -> str:
     return secrets.token_urlsafe(10)
 
 def _cleanup_pages():
+    global PAGES_BYTES
     now = time.time()
-    to_del = [pid for pid, p in PAGES.items() if now - p["ts"] > PAGES_TTL_SEC]
-    for pid in to_del:
-        del PAGES[pid]
+    with PAGES_LOCK:
+        while PAGES_EXPIRY and PAGES_EXPIRY[0][0] <= now:
+            _, pid = heapq.heappop(PAGES_EXPIRY)
+            page = PAGES.get(pid)
+            # The page may have been evicted already, or re-stored with a later expiry.
+            if page and page.expires <= now:
+                del PAGES[pid]
+                PAGES_BYTES -= page.size
 
 def _cleanup_answers():
     now = time.time()
-    to_del = [k for k, v in ANSWER_CACHE.items() if now - v["ts"] > ANSWER_TTL_SEC]
-    for k in to_del:
-        del ANSWER_CACHE[k]
-
-def _save_page(title: str, html: str) -> str:
-    _cleanup_pages()
-    pid = _new_id()
-    PAGES[pid] = {"title": title, "html": html, "ts": time.time()}
-    return pid
+    with ANSWERS_LOCK:
+        # Hits reorder entries, so expired ones can sit anywhere; the cap keeps this scan small.
+        for ck in [ck for ck, ans in ANSWER_CACHE.items() if now - ans["ts"] > ANSWER_TTL_SEC]:
+            del ANSWER_CACHE[ck]
+
+def _cleanup_buckets():
+    if not RATE_PER_SEC:
+        return
+    # An idle bucket has refilled to RATE_BURST, which is what a missing one means anyway.
+    cutoff = time.monotonic() - RATE_BURST / RATE_PER_SEC
+    with BUCKETS_LOCK:
+        for ip in [ip for ip, (_, last) in BUCKETS.items() if last <= cutoff]:
+            del BUCKETS[ip]
+
+def _take_token(ip: str) -> bool:
+    now = time.monotonic()
+    with BUCKETS_LOCK:
+        tokens, last = BUCKETS.get(ip, (RATE_BURST, now))
+        tokens = min(RATE_BURST, tokens + (now - last) * RATE_PER_SEC)
+        if tokens < 1:
+            return False
+        BUCKETS[ip] = (tokens - 1, now)
+        return True
+
+def _remember_answer(ck: str, pid: str, ts: float):
+    with ANSWERS_LOCK:
+        ANSWER_CACHE[ck] = {"page_id": pid, "ts": ts}
+        ANSWER_CACHE.move_to_end(ck)
+        while len(ANSWER_CACHE) > MAX_ANSWERS:
+            ANSWER_CACHE.popitem(last=False)
+
+def _sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SEC)
+        try:
+            _cleanup_pages()
+            _cleanup_answers()
+            _cleanup_buckets()
+        except Exception as e:
+            logger.warning(f"Cache sweep failed: {e}")
+
+_SWEEPER = None
+_SWEEPER_PID = None
+_SWEEPER_LOCK = threading.Lock()
+
+def _start_sweeper():
+    # Started in the serving process (first request, or gunicorn's post_fork), never at import:
+    # a sweeper in a preloading master could hold a cache lock across fork and deadlock the worker.
+    global _SWEEPER, _SWEEPER_PID
+    with _SWEEPER_LOCK:
+        if _SWEEPER_PID != os.getpid() or not _SWEEPER.is_alive():
+            _SWEEPER = threading.Thread(target=_sweep_forever, name="cache-sweeper", daemon=True)
+            _SWEEPER.start()
+            _SWEEPER_PID = os.getpid()
+
+def _store_page(pid: str, page: Page):
+    global PAGES_BYTES
+    with PAGES_LOCK:
+        old = PAGES.pop(pid, None)
+        if old:
+            PAGES_BYTES -= old.size
+        PAGES[pid] = page
+        PAGES_BYTES += page.size
+        heapq.heappush(PAGES_EXPIRY, (page.expires, pid))
+        # The page just stored is last, so stopping at one entry never evicts it.
+        while len(PAGES) > 1 and (len(PAGES) > MAX_PAGES or PAGES_BYTES > MAX_PAGES_BYTES):
+            _, evicted = PAGES.popitem(last=False)
+            PAGES_BYTES -= evicted.size
+    if page.size > MAX_PAGES_BYTES:
+        logger.warning(f"page {pid} is {page.size} bytes, over MAX_PAGES_BYTES={MAX_PAGES_BYTES}")
+
+def _page_record(pid: str, title: str, html_bytes: bytes, ttl: float = PAGES_TTL_SEC) -> Page:
+    etag = hashlib.blake2b(html_bytes, digest_size=16).hexdigest()
+    download_name = secure_filename(f"{title or 'article'}-{pid}.html")
+    br = brotli.compress(html_bytes, quality=PAGE_BROTLI_QUALITY)
+    gz = gzip.compress(html_bytes, compresslevel=PAGE_GZIP_LEVEL)
+    return Page(title=title, html_bytes=html_bytes, br=br, gz=gz, etag=etag, download_name=download_name,
+                expires=time.time() + ttl, size=len(html_bytes) + len(br) + len(gz))
+
+def _save_page(pid: str, title: str, html_bytes: bytes):
+    _store_page(pid, _page_record(pid, title, html_bytes))
 
 def _cache_key(question: str, layout: str, include_citations: bool, brand_class: str, primary: str) -> str:
-    norm = re.sub(r"\s+", " ", (question or "").strip().lower())
+    norm = _WS_RE.sub(" ", (question or "").strip().lower())
     key = f"{norm}|{layout}|{include_citations}|{brand_class}|{primary}"
-    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+# ============ Shared Cache (Redis) ============
+# Process-local dicts stay the first lookup; Redis, when configured, lets
+# other workers and restarts reuse the same WP corpus, answers and pages.
+def _shared_get(key: str):
+    if rds is None:
+        return None
+    try:
+        raw = rds.get(key)
+        return orjson.loads(raw) if raw else None
+    except Exception as e:
+        logger.warning(f"redis get failed for {key}: {e}")
+        return None
+
+def _shared_get_ttl(key: str):
+    # Value plus its remaining TTL, so local copies expire with the shared one.
+    if rds is None:
+        return None, 0
+    try:
+        pipe = rds.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        raw, ttl = pipe.execute()
+        return (orjson.loads(raw) if raw else None), ttl
+    except Exception as e:
+        logger.warning(f"redis get failed for {key}: {e}")
+        return None, 0
+
+def _shared_set(key: str, value, ttl: int):
+    if rds is None:
+        return
+    try:
+        rds.setex(key, ttl, orjson.dumps(value))
+    except Exception as e:
+        logger.warning(f"redis set failed for {key}: {e}")
+
+def _share_page(pid: str, title: str, html_bytes: bytes):
+    if rds is None:
+        return
+    try:
+        pipe = rds.pipeline()
+        pipe.hset(f"page:{pid}", mapping={"title": title, "html": html_bytes})
+        pipe.expire(f"page:{pid}", PAGES_TTL_SEC)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"redis page store failed for {pid}: {e}")
+
+def _get_page(pid: str):
+    global PAGES_BYTES
+    with PAGES_LOCK:
+        page = PAGES.get(pid)
+        # The sweeper runs periodically, so an expired page can still be here; never serve it.
+        if page and page.expires <= time.time():
+            del PAGES[pid]
+            PAGES_BYTES -= page.size
+            page = None
+        elif page:
+            PAGES.move_to_end(pid)
+    if page or rds is None:
+        return page
+    try:
+        pipe = rds.pipeline()
+        pipe.hgetall(f"page:{pid}")
+        pipe.ttl(f"page:{pid}")
+        raw, ttl = pipe.execute()
+    except Exception as e:
+        logger.warning(f"redis page load failed for {pid}: {e}")
+        return None
+    if not raw or ttl == 0:
+        return None
+    # ttl is -1 only if the key somehow lost its expiry; fall back to the full TTL then.
+    page = _page_record(pid, raw[b"title"].decode("utf-8"), raw[b"html"], ttl if ttl > 0 else PAGES_TTL_SEC)
+    _store_page(pid, page)
+    return page
+
+def _get_answer(ck: str):
+    with ANSWERS_LOCK:
+        ans = ANSWER_CACHE.get(ck)
+        if ans and time.time() - ans["ts"] <= ANSWER_TTL_SEC:
+            ANSWER_CACHE.move_to_end(ck)
+            return ans
+    ans, ttl = _shared_get_ttl(f"ans:{ck}")
+    if ans and ttl > 0:
+        # Backfill with a ts that makes the local entry expire when the shared one does.
+        _remember_answer(ck, ans["page_id"], time.time() - (ANSWER_TTL_SEC - ttl))
+    return ans
 
 # ============ WordPress Data Fetchers ============
+def _fetch_wp_page(endpoint: str, params: dict, page: int):
+    r = http.get(f"{WP_BASE}/wp-json/wp/v2/{endpoint}", params={**params, "page": page}, timeout=20)
+    if r.status_code == 400 and "rest_post_invalid_page_number" in r.text:
+        return r, []
+    r.raise_for_status()
+    return r, orjson.loads(r.content) or []
+
+# Page 1 reports X-WP-TotalPages; the remaining pages are fetched concurrently, kept in order.
+def fetch_wp_collection(endpoint: str, params: dict, max_pages: int) -> list:
+    items = []
+    try:
+        r, first = _fetch_wp_page(endpoint, params, 1)
+        items.extend(first)
+        total = min(int(r.headers.get("X-WP-TotalPages") or 1), max_pages)
+        if total > 1:
+            with ThreadPoolExecutor(max_workers=min(WP_FETCH_WORKERS, total - 1)) as pool:
+                for _, page_items in pool.map(lambda page: _fetch_wp_page(endpoint, params, page), range(2, total + 1)):
+                    items.extend(page_items)
+    except Exception as e:
+        logger.error(f"Error fetching WP {endpoint}: {e}")
+    return items
+
+def _build_corpus(items: list) -> dict:
+    post_ids, titles, urls, chunks = [], [], [], []
+    for p in items:
+        pid = p.get("id")
+        title = _strip_html((p.get("title") or {}).get("rendered", "") or "Untitled")
+        link = p.get("link") or ""
+        content = _html_to_text((p.get("content") or {}).get("rendered", ""))
+        for ch in chunk_text(content):
+            post_ids.append(pid)
+            titles.append(title)
+            urls.append(link)
+            chunks.append(ch)
+    return {"post_ids": post_ids, "titles": titles, "urls": urls, "chunks": chunks}
+
 def fetch_wp_posts(per_page=50, max_pages=20):
     now = time.time()
-    if POSTS_CACHE["docs"] and now - POSTS_CACHE["ts"] < TTL:
-        return POSTS_CACHE["docs"]
-    out = []
-    for page in range(1, max_pages + 1):
-        try:
-            r = http.get(f"{WP_BASE}/wp-json/wp/v2/posts",
-                         params={"per_page": per_page, "page": page, "status": "publish", "_fields": "id,link,title,content"},
-                         timeout=20)
-            if r.status_code == 400 and "rest_post_invalid_page_number" in r.text:
-                break
-            r.raise_for_status()
-            items = r.json() or []
-            if not items:
-                break
-            for p in items:
-                pid = p.get("id")
-                title = _strip_html((p.get("title") or {}).get("rendered", "") or "Untitled")
-                link = p.get("link") or ""
-                content = _strip_html((p.get("content") or {}).get("rendered", ""))
-                for ch in chunk_text(content):
-                    out.append({"post_id": pid, "title": title, "url": link, "text_chunk": ch})
-            if len(items) < per_page:
-                break
-        except Exception as e:
-            logger.error(f"Error fetching WP posts: {e}")
-            break
+    if POSTS_CACHE["corpus"]["chunks"] and now - POSTS_CACHE["ts"] < TTL:
+        return POSTS_CACHE["corpus"]
+    shared = _shared_get("wp:posts:v4")
+    if shared:
+        POSTS_CACHE.update(shared)
+        return POSTS_CACHE["corpus"]
+    items = fetch_wp_collection("posts", {"per_page": per_page, "status": "publish", "_fields": "id,link,title,content"}, max_pages)
+    corpus = _build_corpus(items)
     POSTS_CACHE["ts"] = now
-    POSTS_CACHE["docs"] = out
-    return out
+    POSTS_CACHE["corpus"] = corpus
+    if corpus["chunks"]:
+        _shared_set("wp:posts:v4", POSTS_CACHE, TTL)
+    return corpus
 
 def fetch_wp_pages(per_page=50, max_pages=10):
     now = time.time()
-    if PAGES_CACHE["docs"] and now - PAGES_CACHE["ts"] < TTL:
-        return PAGES_CACHE["docs"]
-    out = []
-    for page in range(1, max_pages + 1):
-        try:
-            r = http.get(f"{WP_BASE}/wp-json/wp/v2/pages",
-                         params={"per_page": per_page, "page": page, "_fields": "id,link,title,content"},
-                         timeout=20)
-            if r.status_code == 400 and "rest_post_invalid_page_number" in r.text:
-                break
-            r.raise_for_status()
-            items = r.json() or []
-            if not items:
-                break
-            for p in items:
-                pid = p.get("id")
-                title = _strip_html((p.get("title") or {}).get("rendered", "") or "Untitled")
-                link = p.get("link") or ""
-                content = _strip_html((p.get("content") or {}).get("rendered", ""))
-                for ch in chunk_text(content):
-                    out.append({"post_id": pid, "title": title, "url": link, "text_chunk": ch})
-            if len(items) < per_page:
-                break
-        except Exception as e:
-            logger.error(f"Error fetching WP pages: {e}")
-            break
+    if PAGES_CACHE["corpus"]["chunks"] and now - PAGES_CACHE["ts"] < TTL:
+        return PAGES_CACHE["corpus"]
+    shared = _shared_get("wp:pages:v4")
+    if shared:
+        PAGES_CACHE.update(shared)
+        return PAGES_CACHE["corpus"]
+    items = fetch_wp_collection("pages", {"per_page": per_page, "_fields": "id,link,title,content"}, max_pages)
+    corpus = _build_corpus(items)
     PAGES_CACHE["ts"] = now
-    PAGES_CACHE["docs"] = out
-    return out
+    PAGES_CACHE["corpus"] = corpus
+    if corpus["chunks"]:
+        _shared_set("wp:pages:v4", PAGES_CACHE, TTL)
+    return corpus
 
-def get_all_docs():
-    return fetch_wp_posts() + fetch_wp_pages()
+MEDIA_FIELDS = "id,post,alt_text,caption,media_type,media_details,source_url,title"
+
+def _media_image(m: dict) -> dict:
+    details = m.get("media_details") or {}
+    sizes = details.get("sizes") or {}
+    parts = []
+    for s in sizes.values():
+        u, w = s.get("source_url"), s.get("width")
+        if u and w:
+            parts.append((int(w), f"{u} {w}w"))
+    parts.sort(key=lambda x: x[0])
+    srcset = ", ".join(p[1] for p in parts)
+    return {
+        "id": f"wp_{m['id']}",
+        "url": m.get("source_url"),
+        "title": _strip_html((m.get("title") or {}).get("rendered", "")),
+        "alt": m.get("alt_text") or "",
+        "caption": _strip_html((m.get("caption") or {}).get("rendered", "")),
+        "width": details.get("width"),
+        "height": details.get("height"),
+        "srcset": srcset,
+        "sizes": "100vw",
+    }
 
 def fetch_wp_media(per_page=80, max_pages=10):
     now = time.time()
     if MEDIA_CACHE["imgs"] and now - MEDIA_CACHE["ts"] < TTL:
         return MEDIA_CACHE["imgs"]
+    shared = _shared_get("wp:media:v2")
+    if shared:
+        MEDIA_CACHE.update(shared)
+        return MEDIA_CACHE["imgs"]
+    items = fetch_wp_collection("media", {"per_page": per_page, "_fields": MEDIA_FIELDS}, max_pages)
     imgs = []
-    for page in range(1, max_pages + 1):
-        try:
-            r = http.get(f"{WP_BASE}/wp-json/wp/v2/media",
-                         params={"per_page": per_page, "page": page,
-                                 "_fields": "id,alt_text,caption,media_type,media_details,source_url,title"},
-                         timeout=20)
-            if r.status_code == 400 and "rest_post_invalid_page_number" in r.text:
-                break
-            r.raise_for_status()
-            items = r.json() or []
-            if not items:
-                break
-            for m in items:
-                if m.get("media_type") != "image":
-                    continue
-                details = m.get("media_details") or {}
-                sizes = details.get("sizes") or {}
-                parts = []
-                for s in sizes.values():
-                    u, w = s.get("source_url"), s.get("width")
-                    if u and w:
-                        parts.append((int(w), f"{u} {w}w"))
-                parts.sort(key=lambda x: x[0])
-                srcset = ", ".join(p[1] for p in parts)
-                imgs.append({
-                    "id": f"wp_{m['id']}",
-                    "url": m.get("source_url"),
-                    "title": (m.get("title") or {}).get("rendered", ""),
-                    "alt": m.get("alt_text") or "",
-                    "caption": _strip_html((m.get("caption") or {}).get("rendered", "")),
-                    "width": details.get("width"),
-                    "height": details.get("height"),
-                    "srcset": srcset,
-                    "sizes": "100vw",
-                })
-            if len(items) < per_page:
-                break
-        except Exception as e:
-            logger.warning(f"attachments fetch failed for media page {page}: {e}")
-            break
+    for m in items:
+        if m.get("media_type") != "image":
+            continue
+        img = _media_image(m)
+        img["terms"] = Counter(_tok_cached(f"{img['title']} {img['alt']} {img['caption']}"))
+        imgs.append(img)
     MEDIA_CACHE["ts"] = now
     MEDIA_CACHE["imgs"] = imgs
+    if imgs:
+        _shared_set("wp:media:v2", MEDIA_CACHE, TTL)
     return imgs
 
+def _fetch_post_media(pid) -> list:
+    try:
+        r = http.get(f"{WP_BASE}/wp-json/wp/v2/media",
+                     params={"parent": pid, "per_page": 20, "_fields": MEDIA_FIELDS},
+                     timeout=15)
+        r.raise_for_status()
+        return orjson.loads(r.content) or []
+    except Exception as e:
+        logger.warning(f"attachments fetch failed for post {pid}: {e}")
+        return []
+
 def get_post_attachments(post_ids, k=3):
+    post_ids = list(dict.fromkeys(pid for pid in post_ids or [] if pid))
     if not post_ids:
         return []
+    try:
+        r = http.get(f"{WP_BASE}/wp-json/wp/v2/media",
+                     params=[("per_page", 100), ("_fields", MEDIA_FIELDS), *[("parent[]", pid) for pid in post_ids]],
+                     timeout=20)
+        r.raise_for_status()
+        media_items = orjson.loads(r.content) or []
+    except Exception as e:
+        logger.warning(f"batched attachments fetch failed, falling back to per-post requests: {e}")
+        media_items = []
+        with ThreadPoolExecutor(max_workers=min(WP_FETCH_WORKERS, len(post_ids))) as pool:
+            for items in pool.map(_fetch_post_media, post_ids):
+                media_items.extend(items)
+    by_post = {}
+    for m in media_items:
+        if m.get("media_type") == "image":
+            by_post.setdefault(m.get("post"), []).append(_media_image(m))
     imgs = []
     for pid in post_ids:
-        try:
-            r = http.get(f"{WP_BASE}/wp-json/wp/v2/media",
-                         params={"parent": pid, "per_page": 20,
-                                 "_fields": "id,alt_text,caption,media_type,media_details,source_url,title"},
-                         timeout=15)
-            r.raise_for_status()
-            media_items = r.json() or []
-            for m in media_items:
-                if m.get("media_type") != "image":
-                    continue
-                details = m.get("media_details") or {}
-                sizes = details.get("sizes") or {}
-                parts = []
-                for s in sizes.values():
-                    u, w = s.get("source_url"), s.get("width")
-                    if u and w:
-                        parts.append((int(w), f"{u} {w}w"))
-                parts.sort(key=lambda x: x[0])
-                srcset = ", ".join(p[1] for p in parts)
-                imgs.append({
-                    "id": f"wp_{m['id']}",
-                    "url": m.get("source_url"),
-                    "title": (m.get("title") or {}).get("rendered", ""),
-                    "alt": m.get("alt_text") or "",
-                    "caption": _strip_html((m.get("caption") or {}).get("rendered", "")),
-                    "width": details.get("width"),
-                    "height": details.get("height"),
-                    "srcset": srcset,
-                    "sizes": "100vw",
-                })
-        except Exception as e:
-            logger.warning(f"attachments fetch failed for post {pid}: {e}")
-    return imgs[:k] if len(imgs) > k else imgs
+        imgs.extend(by_post.get(pid, [])[:k])
+    return imgs[:k]
 
 # ============ Search and Ranking ============
 
+def _get_bm25():
+    # Only one thread refetches and reindexes; the rest keep serving the current index,
+    # and wait only on a cold start when there is no index yet.
+    if BM25_REFRESH_LOCK.acquire(blocking=BM25_CACHE["key"] is None):
+        try:
+            posts, pages = fetch_wp_posts(), fetch_wp_pages()
+            key = (POSTS_CACHE["ts"], PAGES_CACHE["ts"])
+            if BM25_CACHE["key"] != key:
+                docs = {f: posts[f] + pages[f] for f in DOC_FIELDS}
+                bm25 = None
+                if docs["chunks"]:
+                    tokens = bm25s.tokenize(docs["chunks"], stopwords="en", stemmer=stemmer, show_progress=False)
+                    bm25 = bm25s.BM25()
+                    bm25.index(tokens, show_progress=False)
+                with BM25_LOCK:
+                    BM25_CACHE.update(key=key, bm25=bm25, docs=docs)
+        finally:
+            BM25_REFRESH_LOCK.release()
+    with BM25_LOCK:
+        return BM25_CACHE["bm25"], BM25_CACHE["docs"], BM25_CACHE["key"]
+
 def search_docs(query: str, k: int=6):
-    docs = get_all_docs()
-    if not docs:
-        return []
-    corpus = [d["text_chunk"] for d in docs]
-    bm25 = BM25Okapi([_tok(t) for t in corpus])
-    scores = bm25.get_scores(_tok(query))
-    M = max(k*5, k)
-    top_idx = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:min(M,len(scores))]
-    candidates = [docs[i] for i in top_idx] or docs[:M]
+    bm25, docs, corpus_key = _get_bm25()
+    if bm25 is None:
+        return [], 0.0
+    rkey = (query, corpus_key, k)
+    with RERANK_LOCK:
+        hit = RERANK_CACHE.get(rkey)
+        if hit:
+            RERANK_CACHE.move_to_end(rkey)
+            return hit
+    chunks = docs["chunks"]
+    M = min(max(k*5, k), len(chunks))
+    q_tokens = bm25s.tokenize(query, stopwords="en", stemmer=stemmer, show_progress=False)
+    top_idx, _ = bm25.retrieve(q_tokens, k=M, show_progress=False)
+    candidates = top_idx[0].tolist()
+
+    def hits(idx):
+        return [{"post_id": docs["post_ids"][i], "title": docs["titles"][i], "url": docs["urls"][i], "text_chunk": chunks[i]}
+                for i in idx]
+
     try:
         rr = co.rerank(model=RERANK_MODEL, query=query,
-                       documents=[c["text_chunk"] for c in candidates],
+                       documents=[chunks[i] for i in candidates],
                        top_n=min(k, len(candidates)))
-        if rr.results:
-            return [candidates[r.index] for r in rr.results]
-        return candidates[:k]
+        if not rr.results:
+            return hits(candidates[:k]), 1.0
     except Exception as e:
         logger.warning(f"rerank failed: {e}")
-        return candidates[:k]
+        return hits(candidates[:k]), 1.0
+    result = (hits(candidates[r.index] for r in rr.results), rr.results[0].relevance_score or 0.0)
+    with RERANK_LOCK:
+        RERANK_CACHE[rkey] = result
+        while len(RERANK_CACHE) > RERANK_CACHE_SIZE:
+            RERANK_CACHE.popitem(last=False)
+    return result
+
+def warm_caches():
+    _get_bm25()
+    fetch_wp_media()
 
 # ============ Planning and Rendering ============
 
@@ -335,141 +625,47 @@ def cohere_plan(prompt: str) -> dict:
     resp = co.generate(model="command-r-plus", prompt=prompt, max_tokens=900, temperature=0.2)
     txt = (resp.generations[0].text or "").strip()
     try:
-        return json.loads(txt)
+        return orjson.loads(txt)
     except Exception:
         start, end = txt.find("{"), txt.rfind("}")
         if start != -1 and end != -1 and end > start:
-            return json.loads(txt[start:end+1])
+            return orjson.loads(txt[start:end+1])
         raise ValueError("Planner did not return valid JSON")
 
 def render_article(plan: dict, citations: list, brand_class: str, include_citations: bool, images: list | None = None) -> str:
     images = images or []
     hero = images[0] if images else None
    # gallery = images[1:] if images and len(images) > 1 else []
-
-    parts = []
-
-    parts.append(f'''
-    <article class="{brand_class}">
-      <header class="{brand_class}__header" role="banner">
-        <h1 class="{brand_class}__title">{plan.get("title", "")}</h1>
-        <p class="{brand_class}__summary" aria-live="polite">{plan.get("summary", "")}</p>
-      </header>
-    ''')
-
-    if hero:
-        parts.append(f'''
-        <figure class="{brand_class}__hero" role="img" aria-label="{hero.get('alt', '')}">
-          <img src="{hero.get('url', '')}" alt="{hero.get('alt', '')}" loading="lazy" decoding="async" class="{brand_class}__hero-image"/>
-          <figcaption class="{brand_class}__hero-caption">{hero.get('caption', '')}</figcaption>
-        </figure>
-        ''')
-
-    if plan.get("show_toc"):
-        parts.append(f'''
-        <nav class="{brand_class}__toc" aria-label="Table of contents">
-          <p class="{brand_class}__toc-title">Contents</p>
-          <ul class="{brand_class}__toc-list">
-        ''')
-        for section in plan.get("sections") or []:
-            parts.append(f'<li><a href="#{section.get("id","")}" class="{brand_class}__toc-link">{section.get("heading","")}</a></li>')
-        parts.append('</ul></nav>')
-
+    sections = []
     for section in plan.get("sections") or []:
-        parts.append(f'<section id="{section.get("id","")}" class="{brand_class}__section" tabindex="-1">')
-        parts.append(f'<h2 class="{brand_class}__section-title">{section.get("heading","")}</h2>')
-
+        paragraphs = []
         for para in section.get("paragraphs") or []:
-            if para.strip().startswith(">"):
-                parts.append(f'<blockquote class="{brand_class}__blockquote">{para.strip()[1:].strip()}</blockquote>')
-            else:
-                parts.append(f'<p class="{brand_class}__paragraph">{para}</p>')
-
-        bullets = section.get("bullets") or []
-        if bullets:
-            parts.append(f'<ul class="{brand_class}__list">')
-            for b in bullets:
-                parts.append(f'<li>{b}</li>')
-            parts.append('</ul>')
-        parts.append('</section>')
-
-    # if gallery:
-    #     parts.append(f'''
-    #     <section class="{brand_class}__gallery" aria-label="Image gallery">
-    #       <h2 class="{brand_class}__gallery-title">Gallery</h2>
-    #       <div class="{brand_class}__gallery-grid">
-    #     ''')
-    #     for img in gallery:
-    #         parts.append(f'''
-    #         <figure class="{brand_class}__gallery-item" role="group" aria-label="{img.get('alt', '')}">
-    #           <img src="{img.get("url")}" alt="{img.get("alt")}" loading="lazy" decoding="async" class="{brand_class}__gallery-image"/>
-    #           <figcaption class="{brand_class}__gallery-caption">{img.get("caption", "")}</figcaption>
-    #         </figure>
-    #         ''')
-    #     parts.append('</div></section>')
-
-    if include_citations and citations:
-        parts.append(f'''
-        <footer class="{brand_class}__sources" aria-label="Content sources">
-          <h2 class="{brand_class}__sources-title">Sources</h2>
-          <ol class="{brand_class}__sources-list">
-        ''')
-        for i, c in enumerate(citations, 1):
-            url = c.get("url") or "#"
-            title = c.get("title") or url
-            parts.append(f'<li id="src-{i}"><a href="{url}" target="_blank" rel="noopener noreferrer">{title}</a></li>')
-        parts.append('</ol></footer>')
-
-    parts.append('</article>')
-
-    return ''.join(parts)
-
-def build_fullpage_html(title: str, article_html: str, brand_class: str, primary: str, trace_id: str, page_id: str, base_url: str,
-                        contact_email=CONTACT_EMAIL, contact_phone=CONTACT_PHONE, contact_url=CONTACT_URL) -> str:
-    canonical = f"{base_url}/v/{page_id}"
-    download_url = f"{canonical}/download"
-    phone_part = f" · Phone: {contact_phone}" if contact_phone else ""
-    safe_title = slugify(title or "article")
-    return f"""<!doctype html>
-<html lang="en">
-<head>
-  <meta charset="utf-8" />
-  <title>{title}</title>
-  <meta name="description" content="Detailed article page for {title}" />
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <meta name="x-trace-id" content="{trace_id}" />
-  <link rel="canonical" href="{canonical}" />
-  <meta property="og:title" content="{title}" />
-  <meta property="og:type" content="article" />
-  <meta property="og:url" content="{canonical}" />
-  <meta name="theme-color" content="{primary}" />
-  <style>
-    :root {{
-      --primary: {primary};
-      --text: #0f172a;
-      --muted: #64748b;
-      --bg: #f3f6fb;
-      --card-bg: rgba(255, 255, 255, 0.3);
-      --border: rgba(15, 23, 42, 0.08);
-      --shadow-default: 0 14px 40px rgba(15, 23, 42, 0.08);
-      --shadow-glass: 0 8px 32px 0 rgba(31, 38, 135, 0.37);
-      --pill-radius: 9999px;
-      --card-radius: 16px;
-      --max-width: 980px;
-      --font-family: ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Inter, Arial, sans-serif;
-    }}
-    html, body {{
+            p = (para or "").strip()
+            quote = p.startswith(">")
+            paragraphs.append({"quote": quote, "html": _clean_text(p[1:].strip() if quote else para, ALLOWED_TAGS)})
+        sections.append({
+            "id": section.get("id", ""),
+            "heading": _clean_text(section.get("heading")),
+            "paragraphs": paragraphs,
+            "bullets": [_clean_text(b) for b in section.get("bullets") or []],
+        })
+    return ARTICLE_TPL.render(title=_clean_text(plan.get("title")), summary=_clean_text(plan.get("summary")),
+                              show_toc=plan.get("show_toc"), sections=sections, citations=citations,
+                              brand_class=brand_class, include_citations=include_citations, hero=hero)
+
+_CSS_STATIC = """\
+    html, body {
       margin: 0; padding: 0;
       background: var(--bg);
       color: var(--text);
       font-family: var(--font-family);
       scroll-behavior: smooth;
       min-height: 100vh;
-    }}
+    }
 
     /* Removed top header for buttons */
 
-    .wrap {{
+    .wrap {
       margin: 18px auto 40px;
       max-width: var(--max-width);
       padding: 0 16px;
@@ -477,9 +673,9 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       display: flex;
       justify-content: center;
       align-items: flex-start;
-    }}
+    }
 
-    .card {{
+    .card {
       background: var(--card-bg);
       border-radius: var(--card-radius);
       box-shadow: var(--shadow-glass);
@@ -492,10 +688,10 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       display: flex;
       flex-direction: column;
       box-sizing: border-box;
-    }}
+    }
 
     /* Moved action buttons inside card, style them */
-    .actions {{
+    .actions {
       display: flex;
       flex-wrap: wrap;
       gap: 8px;
@@ -503,17 +699,17 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       justify-content: flex-end;
       margin-bottom: 1.5rem;
       min-width: 200px;
-    }}
-    @media (max-width: 480px) {{
-      .actions {{
+    }
+    @media (max-width: 480px) {
+      .actions {
         flex-direction: column;
         align-items: stretch;
         gap: 6px;
         min-width: 100%;
-      }}
-    }}
+      }
+    }
 
-    .btn {{
+    .btn {
       display: inline-flex;
       align-items: center;
       gap: 8px;
@@ -528,34 +724,34 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       transition: transform 0.08s ease, filter 0.2s ease;
       font-size: 0.9rem;
       user-select: none;
-    }}
-    .btn:hover {{
+    }
+    .btn:hover {
       filter: brightness(1.02);
-    }}
-    .btn:active {{
+    }
+    .btn:active {
       transform: translateY(1px);
-    }}
-    .btn:focus {{
+    }
+    .btn:focus {
       outline: 2px solid var(--primary);
       outline-offset: 2px;
       outline-style: solid;
-    }}
-    .btn.primary {{
+    }
+    .btn.primary {
       background: var(--primary);
       color: #fff;
       border-color: transparent;
       box-shadow: 0 12px 26px rgba(34,197,94,0.25);
-    }}
+    }
 
     /* Brand chip and contact styling */
-    .brand {{
+    .brand {
       display: flex;
       align-items: center;
       gap: 12px;
       margin-top: 2rem;
       user-select: none;
-    }}
-    .chip {{
+    }
+    .chip {
       width: 36px;
       height: 36px;
       display: grid;
@@ -567,34 +763,77 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       font-size: 18px;
       box-shadow: 0 8px 20px rgba(34, 197, 94, 0.35);
       flex-shrink: 0;
-    }}
-    .brand-name {{
+    }
+    .brand-name {
       font-weight: 600;
       font-size: 1.125rem;
       color: #3b3c4a;
       user-select: text;
-    }}
-    .contact {{
+    }
+    .contact {
       margin-top: 1.25rem;
       font-size: 1rem;
       color: var(--muted, #64748b);
       line-height: 1.5;
-    }}
-    .contact strong {{
+    }
+    .contact strong {
       display: block;
       margin-bottom: 0.4rem;
       color: var(--text);
       font-weight: 600;
-    }}
-    .contact a {{
+    }
+    .contact a {
       color: var(--primary);
       text-decoration: none;
       transition: color 0.2s ease;
-    }}
-    .contact a:hover {{
+    }
+    .contact a:hover {
       text-decoration: underline;
-    }}
+    }
 
+"""
+
+_CSS_PRINT = """\
+    @media print {
+      .actions {
+        display: none !important;
+      }
+      body {
+        background: #fff;
+      }
+      .card {
+        box-shadow: none;
+        border: none;
+        padding: 0;
+        backdrop-filter: none;
+      }
+      a {
+        color: #000;
+        text-decoration: underline;
+      }
+    }
+"""
+
+@functools.lru_cache(maxsize=32)
+def _page_css(brand_class: str, primary: str) -> str:
+    return (f"""
+    :root {{
+      --primary: {primary};
+      --text: #0f172a;
+      --muted: #64748b;
+      --bg: #f3f6fb;
+      --card-bg: rgba(255, 255, 255, 0.3);
+      --border: rgba(15, 23, 42, 0.08);
+      --shadow-default: 0 14px 40px rgba(15, 23, 42, 0.08);
+      --shadow-glass: 0 8px 32px 0 rgba(31, 38, 135, 0.37);
+      --pill-radius: 9999px;
+      --card-radius: 16px;
+      --max-width: 980px;
+      --font-family: ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Inter, Arial, sans-serif;
+    }}
+"""
+            + _CSS_STATIC
+            + f"""\
     /* Spacing between paragraphs and lists */
     .{brand_class} p,
     .{brand_class} li,
@@ -612,25 +851,30 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
       line-height: 1.8;
     }}
 
-    @media print {{
-      .actions {{
-        display: none !important;
-      }}
-      body {{
-        background: #fff;
-      }}
-      .card {{
-        box-shadow: none;
-        border: none;
-        padding: 0;
-        backdrop-filter: none;
-      }}
-      a {{
-        color: #000;
-        text-decoration: underline;
-      }}
-    }}
-  </style>
+"""
+            + _CSS_PRINT)
+
+def build_fullpage_html(title: str, article_html: str, brand_class: str, primary: str, trace_id: str, page_id: str, base_url: str,
+                        contact_email=CONTACT_EMAIL, contact_phone=CONTACT_PHONE, contact_url=CONTACT_URL) -> str:
+    canonical = f"{base_url}/v/{page_id}"
+    download_url = f"{canonical}/download"
+    phone_part = f" · Phone: {contact_phone}" if contact_phone else ""
+    safe_title = slugify(title or "article")
+    title = escape(title)
+    return f"""<!doctype html>
+<html lang="en">
+<head>
+  <meta charset="utf-8" />
+  <title>{title}</title>
+  <meta name="description" content="Detailed article page for {title}" />
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <meta name="x-trace-id" content="{trace_id}" />
+  <link rel="canonical" href="{canonical}" />
+  <meta property="og:title" content="{title}" />
+  <meta property="og:type" content="article" />
+  <meta property="og:url" content="{canonical}" />
+  <meta name="theme-color" content="{primary}" />
+  <style>{_page_css(brand_class, primary)}  </style>
 </head>
 <body>
 
@@ -698,18 +942,54 @@ def build_fullpage_html(title: str, article_html: str, brand_class: str, primary
 
 # ============ Compose Pipeline ============
 
+def _publish_page(ck: str, title: str, article_html: str, brand_class: str, primary: str, trace_id: str, base_url: str) -> dict:
+    pid = _new_id()
+    html_bytes = build_fullpage_html(title, article_html, brand_class, primary, trace_id, pid, base_url).encode("utf-8")
+    _save_page(pid, title, html_bytes)
+    _remember_answer(ck, pid, time.time())
+    _share_page(pid, title, html_bytes)
+    _shared_set(f"ans:{ck}", {"page_id": pid}, ANSWER_TTL_SEC)
+    return {"id": pid, "title": title, "trace_id": trace_id}
+
+def _cached_answer(ck: str, trace_id: str):
+    cached = _get_answer(ck)
+    page = _get_page(cached["page_id"]) if cached else None
+    if page:
+        return {"id": cached["page_id"], "title": page.title, "trace_id": trace_id}
+    return None
+
 def compose_answer_page(question: str, layout: str, include_citations: bool, brand_class: str, primary: str, base_url: str):
     trace_id = trace_id_for(question)
 
-    _cleanup_answers()
     ck = _cache_key(question, layout, include_citations, brand_class, primary)
-    cached = ANSWER_CACHE.get(ck)
-    if cached and cached.get("page_id") in PAGES:
-        pid = cached["page_id"]
-        return {"id": pid, "title": PAGES[pid]["title"], "trace_id": trace_id}
-
+    result = _cached_answer(ck, trace_id)
+    if result:
+        return result
+
+    # Concurrent misses for the same key share one pipeline run instead of each paying for it.
+    with INFLIGHT_LOCK:
+        flight = INFLIGHT.get(ck)
+        leader = flight is None
+        if leader:
+            flight = INFLIGHT[ck] = (threading.Event(), [])
+    done, slot = flight
+    if not leader:
+        if done.wait(COALESCE_TIMEOUT_SEC) and slot:
+            return {**slot[0], "trace_id": trace_id}
+        return _compose_fresh(ck, question, layout, include_citations, brand_class, primary, trace_id, base_url)
+    try:
+        # A previous leader may have published between our cache miss and taking leadership.
+        result = _cached_answer(ck, trace_id) or _compose_fresh(ck, question, layout, include_citations, brand_class, primary, trace_id, base_url)
+        slot.append(result)
+        return result
+    finally:
+        with INFLIGHT_LOCK:
+            del INFLIGHT[ck]
+        done.set()
+
+def _compose_fresh(ck: str, question: str, layout: str, include_citations: bool, brand_class: str, primary: str, trace_id: str, base_url: str) -> dict:
     # Retrieve and rank docs
-    doc_hits = search_docs(question, FINAL_DOCS)
+    doc_hits, top_score = search_docs(question, FINAL_DOCS)
     if not doc_hits:
         plan = {
             "title": "No sources available",
@@ -723,22 +1003,8 @@ def compose_answer_page(question: str, layout: str, include_citations: bool, bra
             }]
         }
         article_html = render_article(plan, [], brand_class, False, images=[])
-        safe_article = sanitize_html(article_html)
-        safe_article = linkify_citations(safe_article, [])
-        title = plan["title"]
-        pid = _save_page(title, build_fullpage_html(title, safe_article, brand_class, primary, trace_id, page_id="tmp", base_url=base_url))
-        full_html = build_fullpage_html(title, safe_article, brand_class, primary, trace_id, pid, base_url)
-        PAGES[pid]["html"] = full_html
-        ANSWER_CACHE[ck] = {"page_id": pid, "ts": time.time()}
-        return {"id": pid, "title": title, "trace_id": trace_id}
-
-    top_score = 1.0
-    try:
-        rr_top = co.rerank(model=RERANK_MODEL, query=question, documents=[d["text_chunk"] for d in doc_hits], top_n=1)
-        if rr_top.results:
-            top_score = rr_top.results[0].relevance_score or 0.0
-    except Exception as e:
-        logger.warning(f"top-score check failed: {e}")
+        article_html = linkify_citations(article_html, [])
+        return _publish_page(ck, plan["title"], article_html, brand_class, primary, trace_id, base_url)
 
     if RERANK_THRESHOLD and top_score < RERANK_THRESHOLD:
         plan = {
@@ -753,14 +1019,8 @@ def compose_answer_page(question: str, layout: str, include_citations: bool, bra
             }],
         }
         article_html = render_article(plan, [], brand_class, False, images=[])
-        safe_article = sanitize_html(article_html)
-        safe_article = linkify_citations(safe_article, [])
-        title = plan["title"]
-        pid = _save_page(title, build_fullpage_html(title, safe_article, brand_class, primary, trace_id, page_id="tmp", base_url=base_url))
-        full_html = build_fullpage_html(title, safe_article, brand_class, primary, trace_id, pid, base_url)
-        PAGES[pid]["html"] = full_html
-        ANSWER_CACHE[ck] = {"page_id": pid, "ts": time.time()}
-        return {"id": pid, "title": title, "trace_id": trace_id}
+        article_html = linkify_citations(article_html, [])
+        return _publish_page(ck, plan["title"], article_html, brand_class, primary, trace_id, base_url)
 
     sources = [{"title": h.get("title") or "Untitled", "url": h.get("url") or "", "text_chunk": h.get("text_chunk")[:1800]} for h in doc_hits[:FINAL_DOCS]]
     citations = dedupe_citations([{"title": s["title"], "url": s.get("url","")} for s in sources])
@@ -768,13 +1028,8 @@ def compose_answer_page(question: str, layout: str, include_citations: bool, bra
     post_ids = [h.get("post_id") for h in doc_hits if h.get("post_id")]
     images = get_post_attachments(post_ids, k=3)
     if not images:
-        all_imgs = fetch_wp_media()
-        terms = _tok(question)
-        for i in all_imgs:
-            text = " ".join([i.get("title",""), i.get("alt",""), i.get("caption","")]).lower()
-            i["score"] = sum(text.count(t) for t in terms)
-        all_imgs.sort(key=lambda x: x.get("score",0), reverse=True)
-        images = all_imgs[:3]
+        terms = _tok_cached(question)
+        images = sorted(fetch_wp_media(), key=lambda i: sum(i["terms"].get(t, 0) for t in terms), reverse=True)[:3]
 
     prompt = build_planner_prompt(question, sources, layout, include_citations)
     try:
@@ -790,50 +1045,78 @@ def compose_answer_page(question: str, layout: str, include_citations: bool, bra
         }
 
     article_html = render_article(plan, citations, brand_class, include_citations, images=images)
-    safe_article = sanitize_html(article_html)
-    safe_article = linkify_citations(safe_article, citations)
+    article_html = linkify_citations(article_html, citations)
     title = plan.get("title") or "Article"
-
-    page_id = _save_page(title, build_fullpage_html(title, safe_article, brand_class, primary, trace_id, page_id="tmp", base_url=base_url))
-    full_html = build_fullpage_html(title, safe_article, brand_class, primary, trace_id, page_id, base_url)
-    PAGES[page_id]["html"] = full_html
-    ANSWER_CACHE[ck] = {"page_id": page_id, "ts": time.time()}
-    return {"id": page_id, "title": title, "trace_id": trace_id}
+    return _publish_page(ck, title, article_html, brand_class, primary, trace_id, base_url)
 
 # ============ Flask Routes ============
+_API_KEY = BACKEND_API_KEY.encode("utf-8")
+_UNAUTH = (b'{"error":"Unauthorized"}', 401)
+_NOQ = (b'{"error":"No question provided"}', 400)
+# Browsers re-request the favicon on every navigation unless told it never changes.
+_FAVICON = (b"", 204, {"Cache-Control": "public, max-age=31536000, immutable"})
+_RATE_LIMITED = (b'{"error":"Too many requests"}', 429)
+_BAD_BODY = (b'{"error":"Invalid request body"}', 400)
+
+class ComposeReq(msgspec.Struct, frozen=True):
+    question: str = ""
+    layout: str = "guide"
+    include_citations: bool = True
+    brand_class: str = "agent42labs"
+    primary: str = "#21808d"
+
+def _json_err(body: bytes, status: int):
+    return Response(body, status=status, mimetype="application/json")
+
+def _ok(obj):
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+def _chunks(data: bytes):
+    for i in range(0, len(data), DOWNLOAD_CHUNK):
+        yield data[i:i + DOWNLOAD_CHUNK]
+
+@app.before_request
+def _ensure_sweeper():
+    # Covers servers without gunicorn's post_fork hook (uWSGI, flask run, the dev server).
+    if _SWEEPER_PID != os.getpid():
+        _start_sweeper()
+
 @app.get("/healthz")
 def healthz():
-    return jsonify({
+    return _ok({
         "ok": True,
         "wp_base": WP_BASE,
-        "posts_cached": len(POSTS_CACHE["docs"]),
-        "pages_cached": len(PAGES_CACHE["docs"]),
+        "posts_cached": len(POSTS_CACHE["corpus"]["chunks"]),
+        "pages_cached": len(PAGES_CACHE["corpus"]["chunks"]),
         "media_cached": len(MEDIA_CACHE["imgs"]),
         "pages_stored": len(PAGES),
+        "pages_bytes": PAGES_BYTES,
         "answer_cache": len(ANSWER_CACHE),
+        "shared_cache": rds is not None,
     })
 
 @app.post("/compose")
 def compose():
-    if BACKEND_API_KEY:
-        provided = request.headers.get("X-Backend-Api-Key", "")
-        if provided != BACKEND_API_KEY:
-            return jsonify({"error": "Unauthorized"}), 401
+    if RATE_PER_SEC and not _take_token(request.remote_addr):
+        return _json_err(*_RATE_LIMITED)
 
-    data = request.get_json(silent=True) or {}
-    question = (data.get("question") or "").strip()
-    layout = data.get("layout", "guide")
-    include_citations = bool(data.get("include_citations", True))
-    brand_class = data.get("brand_class", "agent42labs")
-    primary = data.get("primary", "#21808d")
+    if _API_KEY:
+        provided = request.headers.get("X-Backend-Api-Key", "")
+        if not hmac.compare_digest(provided.encode("utf-8"), _API_KEY):
+            return _json_err(*_UNAUTH)
 
+    try:
+        req = msgspec.json.decode(request.get_data(cache=False), type=ComposeReq)
+    except msgspec.DecodeError:
+        return _json_err(*_BAD_BODY)
+    question = req.question.strip()
     if not question:
-        return jsonify({"error": "No question provided"}), 400
+        return _json_err(*_NOQ)
 
     base_url = request.host_url.rstrip("/")
-    result = compose_answer_page(question, layout, include_citations, brand_class, primary, base_url)
+    result = compose_answer_page(question, req.layout, req.include_citations, req.brand_class, req.primary, base_url)
     page_url = f"{base_url}/v/{result['id']}"
-    return jsonify({
+    return _ok({
         "id": result["id"],
         "title": result["title"],
         "trace_id": result["trace_id"],
@@ -842,25 +1125,37 @@ def compose():
 
 @app.get("/v/<page_id>")
 def view_page(page_id):
-    _cleanup_pages()
-    page = PAGES.get(page_id)
+    page = _get_page(page_id)
     if not page:
         abort(404, description="Page not found")
-    return Response(page["html"], mimetype="text/html")
+    if request.if_none_match.contains_weak(page.etag):
+        resp = Response(status=304)
+    elif request.accept_encodings["br"]:
+        resp = Response(page.br, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "br"
+    elif request.accept_encodings["gzip"]:
+        resp = Response(page.gz, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(page.html_bytes, mimetype="text/html")
+    resp.set_etag(page.etag, weak=True)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = "private, max-age=300"
+    return resp
 
 @app.get("/v/<page_id>/download")
 def download_page(page_id):
-    _cleanup_pages()
-    page = PAGES.get(page_id)
+    page = _get_page(page_id)
     if not page:
         abort(404, description="Page not found")
-    filename = secure_filename(f"{page.get('title', 'article')}-{page_id}.html")
-    buf = io.BytesIO(page["html"].encode("utf-8"))
-    return send_file(buf, mimetype="text/html", as_attachment=True, download_name=filename)
+    html_bytes = page.html_bytes
+    headers = {"Content-Disposition": f'attachment; filename="{page.download_name}"', "Content-Length": str(len(html_bytes))}
+    return Response(_chunks(html_bytes), mimetype="text/html", headers=headers)
 
 @app.get("/favicon.ico")
 def favicon():
-    return "", 204
+    return Response(*_FAVICON)
 
+# Local development only; production runs `gunicorn -c gunicorn.conf.py app1:app`.
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=PORT, debug=False)
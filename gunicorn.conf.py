@@ -0,0 +1,31 @@
+import os
+
+# gunicorn -c gunicorn.conf.py app1:app
+bind = "0.0.0.0:8080"
+# Behind a reverse proxy, set TRUSTED_PROXIES in app1.py so client addresses come from X-Forwarded-For.
+# More than one worker needs REDIS_URL set in app1.py so /v/<id> resolves on any worker.
+# The /compose rate limit, when enabled, is enforced per worker, so the effective limit scales with this.
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Threads let one worker keep serving /v/<id> while other requests wait on WP and Cohere.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# Heartbeat files on tmpfs so a slow disk cannot make the arbiter think workers hung.
+worker_tmp_dir = "/dev/shm"
+# Hold idle connections a little longer than the 2s default so back-to-back
+# /compose calls from the frontend reuse the socket.
+keepalive = 5
+# Import the app once in the master so the warmed WP corpus and BM25 index
+# are inherited copy-on-write by every worker instead of rebuilt per process.
+preload_app = True
+
+
+def when_ready(server):
+    import app1
+    app1.warm_caches()
+
+
+def post_fork(server, worker):
+    import app1
+    # Pooled sockets opened by the master must not be shared between processes.
+    app1.http.close()
+    app1._start_sweeper()